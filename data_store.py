@@ -1,10 +1,14 @@
 from datetime import datetime
+from numbers import Number
 from os import path
 
+from numpy import full, nan
 from pandas import DataFrame
 
 
 class DataStore:
+    INITIAL_CAPACITY = 1024
+
     def __init__(self):
         self.reset()
 
@@ -13,12 +17,30 @@ class DataStore:
 
     def reset(self):
         self.lastrow = {}
-        self.data = DataFrame()
+        # one preallocated array per key, the first self.size entries are used
+        self.columns = {}
+        self.size = 0
+        self.capacity = 0
+        self._frame = None
 
     def append(self, row):
         print(row)
         self.lastrow = row
-        self.data = self.data.append(row, ignore_index=True)
+        if self.size == self.capacity:
+            self.__grow(max(2 * self.capacity, DataStore.INITIAL_CAPACITY))
+        for key, value in row.items():
+            if key not in self.columns:
+                self.columns[key] = self.__column(value, self.capacity)
+            self.columns[key][self.size] = value
+        self.size += 1
+        self._frame = None
+
+    @property
+    def data(self):
+        if self._frame is None:
+            self._frame = DataFrame({key: column[:self.size]
+                                     for key, column in self.columns.items()})
+        return self._frame
 
     def write(self, basedir, prefix):
         filename = "{}_raw_{}.csv".format(prefix, datetime.now().strftime("%Y%m%d_%H%M%S"))
@@ -26,7 +48,7 @@ class DataStore:
         export_rows = self.data.drop_duplicates()
         if export_rows.shape[0]:
             print("Write RAW data to {}".format(path.relpath(full_path)))
-            self.data.drop_duplicates().to_csv(full_path)
+            export_rows.to_csv(full_path)
         else:
             print("no data")
 
@@ -35,3 +57,16 @@ class DataStore:
 
     def lastval(self, key):
         return self.lastrow[key]
+
+    def __grow(self, capacity):
+        for key, column in self.columns.items():
+            grown = full(capacity, nan if column.dtype.kind == 'f' else None,
+                         dtype=column.dtype)
+            grown[:self.size] = column[:self.size]
+            self.columns[key] = grown
+        self.capacity = capacity
+
+    def __column(self, value, capacity):
+        if isinstance(value, Number) and not isinstance(value, bool):
+            return full(capacity, nan)
+        return full(capacity, None, dtype=object)
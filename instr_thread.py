@@ -1,4 +1,5 @@
-from time import sleep
+from queue import Empty, Queue
+from time import monotonic
 
 from PyQt5.QtCore import QObject, QRunnable, pyqtSignal, pyqtSlot
 
@@ -15,6 +16,8 @@ class InstrumentSignals(QObject):
 
 
 class InstrumentWorker(QRunnable):
+    POLL_INTERVAL = .5
+
     def __init__(self):
         super().__init__()
         self.signals = InstrumentSignals()
@@ -25,7 +28,7 @@ class InstrumentWorker(QRunnable):
 
         self.loop = True
         self.running = False
-        self.commands = []
+        self.commands = Queue()
 
     @pyqtSlot()
     def run(self):
@@ -36,12 +39,17 @@ class InstrumentWorker(QRunnable):
             return
 
         self.signals.status_update.emit("Connected to {} on {}".format(self.instr.name, self.instr.port))
+        next_read = monotonic()
         while self.loop:
-            if len(self.commands) > 0:
-                self.handle_command(self.commands.pop(0))
+            # wait for commands until the next read is due, run them right away
+            try:
+                self.handle_command(self.commands.get(timeout=max(0., next_read - monotonic())))
+                continue
+            except Empty:
+                pass
             if self.running:
                 self.signals.data_row.emit(self.instr.readAll())
-            sleep(.5)
+            next_read = monotonic() + InstrumentWorker.POLL_INTERVAL
 
         self.instr.close()
 
@@ -59,4 +67,4 @@ class InstrumentWorker(QRunnable):
         self.loop = False
 
     def add_command(self, cmd):
-        self.commands.append(cmd)
+        self.commands.put(cmd)
@@ -6,17 +6,41 @@ licensed as GPLv3
 """
 
 from datetime import time
-from math import modf
 from numbers import Number
-from time import sleep
+from struct import Struct
+from sys import platform
+from time import monotonic, sleep
 from numpy import byte
 
 import pyvisa as visa
 
 from instruments.instrument import Instrument
+from instruments.serial_port import SerialPort
+
+# command byte + 3 byte big endian value, the command byte is masked off
+_PARSE_VAL = Struct('>I')
+# hh mm ss
+_PARSE_TIME = Struct('>BBB')
+# B1 B2 command value B6
+_FRAME = Struct('>BBB2sB')
+# command values: integer and hundredths, or a plain 16 bit word
+_PACK_FIXED = Struct('>BB')
+_PACK_WORD = Struct('>H')
+_HEADER = b'\xCA\xCB'
+
+
+def _find_frame(buf, header):
+    """
+    Index of the first answer frame in buf starting with header (CA CB plus
+    the command byte), -1 if none.
+    """
+    return buf.find(header)
 
 
 class DL24M(Instrument):
+    __slots__ = ('device', 'name', 'port', 'aux_index', 'aux_rounds',
+                 'dirty_aux', 'verbose', 'batch_reads', 'batch_failures',
+                 'rx_buf', 'use_raw_fd', 'data')
 
     ISON = 0x10
     VOLTAGE = 0x11
@@ -39,6 +63,16 @@ class DL24M(Instrument):
     SETMODE = 0x06 # with values 0x00 0x00=CC CV=0x00 0x01 CR=0x00 0x02 CP=0x00 0x03
     UNKNOW = 0x07  # on stop it sends 0x01 0x00 0x00 and 0x07 0x00 0x001
 
+    # max number of extra reads while looking for a frame start
+    RESYNC_TRIES = 4
+
+    # readback polling after a command, in seconds
+    VERIFY_TIMEOUT = 1.5
+    VERIFY_INTERVAL = 0.05
+
+    # consecutive failed batched reads before falling back to single reads
+    BATCH_MAX_FAILURES = 3
+
     ENABLED = 0x0100
     DISABLED = 0x0000
 
@@ -66,6 +100,10 @@ class DL24M(Instrument):
         'set_timer': TIMER,
     }
 
+    # query frames are constant, build them once
+    QUERY_FRAMES = {cmd: bytes((0xB1, 0xB2, cmd, 0x00, 0x00, 0xB6))
+                    for cmd in KEY_CMDS.values()}
+
     FREQ_VALS = [
         'is_on',
         'voltage',
@@ -82,6 +120,15 @@ class DL24M(Instrument):
         'set_timer',
     ]
 
+    # aux values that only change on a command (or the front panel), they are
+    # polled while not known and refreshed every SETPOINT_REFRESH aux rounds
+    SETPOINTS = frozenset((
+        'set_current',
+        'set_voltage',
+        'set_timer',
+    ))
+    SETPOINT_REFRESH = 10
+
     COMMANDS = {
         Instrument.COMMAND_ENABLE: OUTPUT_ON,
         Instrument.COMMAND_SET_VOLTAGE: SETVCUT,
@@ -98,11 +145,23 @@ class DL24M(Instrument):
         Instrument.COMMAND_RESET: 'cap_ah',
     }
 
-    def __init__(self, device):
+    def __init__(self, device, use_raw_fd=False):
         print(device)
         self.device = device
         self.name = "DL24M"
+        # talk to the tty through pyserial instead of pyvisa, linux only
+        self.use_raw_fd = use_raw_fd and platform.startswith('linux')
         self.aux_index = 0
+        self.aux_rounds = 0
+        # setpoints that need to be read from the device
+        self.dirty_aux = set(DL24M.SETPOINTS)
+        # dump every received value frame
+        self.verbose = False
+        # cleared if the device does not answer queued queries
+        self.batch_reads = True
+        self.batch_failures = 0
+        # received bytes not consumed yet, kept between reads
+        self.rx_buf = bytearray()
         self.data = {
             'is_on': 0.,
             'voltage': 0.,
@@ -118,14 +177,22 @@ class DL24M(Instrument):
 
     def probe(self):
         print("probe")
-        if not isinstance(self.device, visa.resources.SerialInstrument):
+        if isinstance(self.device, SerialPort):
+            # already switched to the raw port by an earlier probe
+            self.port = self.device.resource_name
+        elif isinstance(self.device, visa.resources.SerialInstrument):
+            self.port = self.device.resource_name.split('::')[0].replace('ASRL', '')
+        else:
             return False
 
-        self.port = self.device.resource_name.split('::')[0].replace('ASRL', '')
         self.__setup_device()
         self.__clear_device()
 
-        return self.__is_number(self.getVal(DL24M.VOLTAGE))
+        if not self.__is_number(self.getVal(DL24M.VOLTAGE)):
+            return False
+        if self.use_raw_fd and not isinstance(self.device, SerialPort):
+            self.__open_raw()
+        return True
 
     def readAll(self, read_all_aux=False):
         print("readAll")
@@ -140,6 +207,8 @@ class DL24M(Instrument):
         return self.data
 
     def update_vals(self, keys):
+        if self.batch_reads and len(keys) > 1:
+            keys = self.__update_vals_batched(keys)
         for key in keys:
             self.update_val(key)
 
@@ -147,66 +216,63 @@ class DL24M(Instrument):
         value = self.getVal(DL24M.KEY_CMDS[key])
         if (value is not False):
             self.data[key] = value
+            self.dirty_aux.discard(key)
 
     def command(self, command, value):
-        if command not in (DL24M.COMMANDS.keys()):
+        if command not in DL24M.COMMANDS:
             return False
 
+        cmd = DL24M.COMMANDS[command]
+        verify_key = DL24M.VERIFY_CMD[command]
+        if verify_key in DL24M.SETPOINTS:
+            self.dirty_aux.add(verify_key)
         for i in range(0, 3):
-            self.setVal(DL24M.COMMANDS[command], value)
-            sleep(0.5)
-            self.update_val(DL24M.VERIFY_CMD[command])
-            if self.data[DL24M.VERIFY_CMD[command]] == value:
+            self.setVal(cmd, value)
+            if self.__wait_verify(verify_key, value):
                 break
             print("retry " + command)
-            print(self.data[DL24M.VERIFY_CMD[command]])
+            print(self.data[verify_key])
             print(value)
-            sleep(0.7)
 
         if (command == Instrument.COMMAND_RESET):
             self.update_vals(DL24M.AUX_VALS)
 
     def getVal(self, command):
-        ret = self.writeFunction(command, [0, 0])
+        return self.__parse_val(command, self.writeFunction(command, [0, 0]))
+
+    def __parse_val(self, command, ret):
         if (not ret or len(ret) == 0):
             print("no answer")
             return False
         elif (len(ret) == 1 and ret[0] == 0x6F):
             print("setval")
             return False
-        elif (len(ret) < 8 or ret[0] != 0xCA or ret[1] != 0xCB
-              or ret[6] != 0xCE or ret[7] != 0xCF or ret[2] != command):
+        elif (len(ret) != 8 or not ret.startswith(_HEADER)
+              or not ret.endswith(b'\xCE\xCF') or ret[2] != command):
             print("Receive error")
             return False
 
-        try:
-            mult = DL24M.MUL[command]
-        except:
-            mult = 1000.
-
         if (command == DL24M.TIME or command == DL24M.TIMER):
-            hh = ret[3]
-            mm = ret[4]
-            ss = ret[5]
+            hh, mm, ss = _PARSE_TIME.unpack_from(ret, 3)
             return time(hh, mm, ss)  #'{:02d}:{:02d}:{:02d}'.format(hh, mm, ss)
         else:
-            print(ret)
-            print(command, bytes(ret).hex("-"))
-            return int.from_bytes(ret[3:6], byteorder='big') / mult
+            if __debug__ and self.verbose:
+                print(command, bytes(ret).hex("-"))
+            return ((_PARSE_VAL.unpack_from(ret, 2)[0] & 0xFFFFFF)
+                    / DL24M.MUL.get(command, 1000.))
 
     def setVal(self, command, value):
         if isinstance(value, float):
-            f, i = modf(value)
-            value = [int(i), round(f * 100)]
+            value = _PACK_FIXED.pack(*divmod(round(value * 100), 100))
         elif isinstance(value, time):
-            value = (value.second + value.minute * 60 +
-                     value.hour * 3600).to_bytes(2, byteorder='big')
+            value = _PACK_WORD.pack(value.second + value.minute * 60 +
+                                    value.hour * 3600)
         elif (command == DL24M.OUTPUT_ON and value):
-            value = [0x01, 0x00]
+            value = b'\x01\x00'
         else:
-            value = value.to_bytes(2, byteorder='big')
+            value = _PACK_WORD.pack(value)
         ret = self.writeFunction(command, value)
-        return ret == None
+        return ret is None
 
     def writeFunction(self, command, value):
         if command >= 0x10:
@@ -214,52 +280,15 @@ class DL24M(Instrument):
         else:
             resp_len = 0
 
-        frame = bytearray([0xB1, 0xB2, command, *value, 0xB6])
+        if value == [0, 0] and command in DL24M.QUERY_FRAMES:
+            frame = DL24M.QUERY_FRAMES[command]
+        else:
+            frame = _FRAME.pack(0xB1, 0xB2, command, bytes(value), 0xB6)
         try:
             self.device.write_raw(frame)
             if resp_len == 0:
                 return None
-            bytes_read = self.device.read_bytes(resp_len)
-            if (bytes_read[0] != 0xCA or bytes_read[1] != 0xCB):  # this is a var length status message, skip to CA, CB?
-                # see if we read 0xCA already
-                try:
-                    idx = bytes_read.index(0xCA)
-                    if (idx+1 < resp_len):
-                        # we are at the start of the frame
-                        if (bytes_read[idx+1] == 0xCB):
-                            response = bytes_read[idx:]
-                            bytes_left = resp_len - len(response)
-                            response += self.device.read_bytes(bytes_left)
-                            bytes_read = response
-                        else:
-                            bytee = bytes([0x00,])
-                            while (len(bytee) != 2 or bytee[0] != 0xCA or bytee[1] != 0xCB):
-                                if (len(bytee) == 2): # if we get here we got first byte right but 2nd wrong
-                                    bytee = bytes([bytee[1], 0x00])
-                                while(bytee[0] != 0xCA):
-                                    bytee = self.device.read_bytes(1)
-                                bytee += self.device.read_bytes(1)
-                            bytes_read = bytee + self.device.read_bytes(6)
-                    else: # there is no further byte to probe
-                        bytee = bytes([bytes_read[idx]])
-                        while (len(bytee) != 2 or bytee[0] != 0xCA or bytee[1] != 0xCB):
-                            if (len(bytee) == 2): # if we get here we got first byte right but 2nd wrong
-                                bytee = bytes([bytee[1], 0x00])
-                            while(bytee[0] != 0xCA):
-                                bytee = self.device.read_bytes(1)
-                            bytee += self.device.read_bytes(1)
-                        bytes_read = bytee + self.device.read_bytes(6)
-                except ValueError:
-                    # we do not have the start yet
-                    bytee = bytes([0x00,])
-                    while (len(bytee) != 2 or bytee[0] != 0xCA or bytee[1] != 0xCB):
-                        if (len(bytee) == 2): # if we get here we got first byte right but 2nd wrong
-                            bytee = bytes([bytee[1], 0x00])
-                        while(bytee[0] != 0xCA):
-                            bytee = self.device.read_bytes(1)
-                        bytee += self.device.read_bytes(1)
-                    bytes_read = bytee + self.device.read_bytes(6)
-            return bytes_read
+            return self.__read_frame(command, resp_len)
         except Exception as inst:
             print(type(inst))    # the exception instance
             print(inst.args)     # arguments stored in .args
@@ -276,7 +305,29 @@ class DL24M(Instrument):
         sleep(.2)
         self.device.close()
 
+    def __open_raw(self):
+        try:
+            device = SerialPort(self.port)
+        except Exception as inst:
+            print(inst)
+            print("can not open {}, staying on pyvisa".format(self.port))
+            return
+        # only let go of the pyvisa resource once the load answers on the raw port
+        visa_device, self.device = self.device, device
+        self.__clear_device()
+        if self.__is_number(self.getVal(DL24M.VOLTAGE)):
+            visa_device.close()
+            return
+        print("no answer on {}, staying on pyvisa".format(self.port))
+        device.close()
+        self.device = visa_device
+        self.__clear_device()
+
     def __setup_device(self):
+        # pyserial ports are configured on open, visa ones only once
+        if (isinstance(self.device, SerialPort)
+                or getattr(self.device, '_dl24m_configured', False)):
+            return
         try:
             self.device.timeout = 500
             self.device.baud_rate = 9600
@@ -284,11 +335,18 @@ class DL24M(Instrument):
             self.device.stop_bits = visa.constants.StopBits.one
             self.device.parity = visa.constants.Parity.none
             self.device.flow_control = visa.constants.ControlFlow.none
-        except  e:
+            self.device._dl24m_configured = True
+        except Exception as e:
             print(e)
-            pass
 
     def __clear_device(self):
+        self.rx_buf.clear()
+        try:
+            self.device.flush(visa.constants.BufferOperation.discard_read_buffer)
+            return
+        except Exception:
+            pass
+        # flush not supported by the backend, drain whatever is buffered
         try:
             self.device.read_bytes(self.device.bytes_in_buffer)
         except Exception as inst:
@@ -296,14 +354,106 @@ class DL24M(Instrument):
             print(inst.args)     # arguments stored in .args
             print(inst)
             print("error reading bytes")
-            self.device.close
             return False
 
+    def __wait_verify(self, key, value):
+        data = self.data
+        deadline = monotonic() + DL24M.VERIFY_TIMEOUT
+        while True:
+            self.update_val(key)
+            if data[key] == value:
+                return True
+            if monotonic() >= deadline:
+                return False
+            sleep(DL24M.VERIFY_INTERVAL)
+
+    def __update_vals_batched(self, keys):
+        """
+        Send the queries for all keys at once and read all answers with one read.
+        Returns the keys that got no usable answer.
+        """
+        cmds = [DL24M.KEY_CMDS[key] for key in keys]
+        frames = b''.join(DL24M.QUERY_FRAMES[cmd] for cmd in cmds)
+        try:
+            self.device.write_raw(frames)
+            self.rx_buf += self.device.read_bytes(8 * len(cmds))
+        except Exception as inst:
+            print(inst)
+            print("batched read failed")
+            self.batch_failures += 1
+            if self.batch_failures >= DL24M.BATCH_MAX_FAILURES:
+                print("using single reads")
+                self.batch_reads = False
+            return keys
+
+        missing = []
+        for key, cmd in zip(keys, cmds):
+            value = self.__parse_val(cmd, self.__take_frame(cmd, 8))
+            if value is False:
+                missing.append(key)
+            else:
+                self.data[key] = value
+                self.dirty_aux.discard(key)
+
+        if len(missing) == len(keys):
+            print("no batched answers, using single reads")
+            self.batch_reads = False
+        else:
+            self.batch_failures = 0
+        return missing
+
+    def __take_frame(self, command, resp_len):
+        """
+        Remove the first complete answer frame for command from the receive
+        buffer and return it, None if there is none buffered yet.
+        """
+        buf = self.rx_buf
+        idx = _find_frame(buf, _HEADER + bytes((command,)))
+        if idx < 0 or len(buf) < idx + resp_len:
+            return None
+        frame = bytes(buf[idx:idx + resp_len])
+        del buf[:idx + resp_len]
+        return frame
+
+    def __read_frame(self, command, resp_len):
+        """
+        Read until an answer frame for command is complete. Anything in front
+        of it (status messages, stale answers) is skipped, bytes after it stay
+        buffered for the next read.
+        """
+        buf = self.rx_buf
+        header = _HEADER + bytes((command,))
+        tries = 0
+        while True:
+            idx = _find_frame(buf, header)
+            if idx < 0:
+                # keep a partial header at the end, drop everything else
+                keep = next((n for n in (2, 1) if buf.endswith(header[:n])), 0)
+                del buf[:len(buf) - keep]
+                missing = resp_len - keep
+            else:
+                del buf[:idx]
+                missing = resp_len - len(buf)
+            if missing <= 0:
+                return self.__take_frame(command, resp_len)
+            if tries > DL24M.RESYNC_TRIES:
+                print("no frame start found")
+                return False
+            buf += self.device.read_bytes(missing)
+            tries += 1
+
     def __next_aux(self):
-        self.aux_index += 1
-        if self.aux_index >= len(DL24M.AUX_VALS):
-            self.aux_index = 0
-        return self.aux_index
+        # cap_wh and temp are always polled, so this ends within one round
+        while True:
+            self.aux_index += 1
+            if self.aux_index >= len(DL24M.AUX_VALS):
+                self.aux_index = 0
+                self.aux_rounds += 1
+                if self.aux_rounds % DL24M.SETPOINT_REFRESH == 0:
+                    self.dirty_aux.update(DL24M.SETPOINTS)
+            key = DL24M.AUX_VALS[self.aux_index]
+            if key not in DL24M.SETPOINTS or key in self.dirty_aux:
+                return self.aux_index
 
     def __is_number(self, value):
         return isinstance(value, Number) and not isinstance(value, bool)
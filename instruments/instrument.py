@@ -1,4 +1,6 @@
 class Instrument:
+    __slots__ = ()
+
     COMMAND_ENABLE = 'cmd_enable'
     COMMAND_SET_VOLTAGE = 'cmd_set_voltage'
     COMMAND_SET_CURRENT = 'cmd_set_current'
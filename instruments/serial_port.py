@@ -0,0 +1,55 @@
+"""
+Copyright Constantin Wenger
+licensed as GPLv3
+"""
+
+import serial
+
+
+class SerialPort:
+    """
+    Minimal stand in for a pyvisa SerialInstrument on top of pyserial,
+    providing only what the instrument drivers use.
+
+    Reads and writes stay plain blocking tty calls. io_uring would not help
+    here: at 9600 baud an 8 byte answer takes ~8 ms on the wire, which
+    dwarfs any syscall cost, and batched queries already need only one
+    write and one read per poll.
+    """
+
+    def __init__(self, port, baud_rate=9600, timeout=500):
+        self.resource_name = port
+        self.serial = serial.Serial(port, baud_rate,
+                                    bytesize=serial.EIGHTBITS,
+                                    parity=serial.PARITY_NONE,
+                                    stopbits=serial.STOPBITS_ONE,
+                                    timeout=timeout / 1000.)
+
+    @property
+    def timeout(self):
+        """timeout in ms, like pyvisa"""
+        return self.serial.timeout * 1000.
+
+    @timeout.setter
+    def timeout(self, value):
+        self.serial.timeout = value / 1000.
+
+    @property
+    def bytes_in_buffer(self):
+        return self.serial.in_waiting
+
+    def write_raw(self, message):
+        return self.serial.write(message)
+
+    def read_bytes(self, count):
+        data = self.serial.read(count)
+        if len(data) < count:
+            # pyvisa raises on timeout instead of returning short reads
+            raise TimeoutError("read {} of {} bytes".format(len(data), count))
+        return data
+
+    def flush(self, mask=None):
+        self.serial.reset_input_buffer()
+
+    def close(self):
+        self.serial.close()